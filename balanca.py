@@ -1,64 +1,95 @@
 
 # balanca_bridge.py
 # Xiaomi Smart Scale S200 → (local) WebSocket → Browser
-# Reqs: pip install bleak==0.22.3 pycryptodome websockets
+# Reqs: pip install bleak==0.22.3 cryptography "websockets>=17" orjson
 #
 # How it works:
 # - Listens to FE95 (MiBeacon) from your S200 (same logic as your model code)
 # - When a weight packet is decrypted, streams live readings over ws://127.0.0.1:8765
-# - When the weight stabilizes, broadcasts {"type":"weight","kg":X,"stable":true}
+# - Readings are batched (~50 ms) into {"type":"weights","items":[{"kg":X,"stable":false}, ...]}
+# - When the weight stabilizes, the batch carries an item {"kg":X,"stable":true}
 #
 # Open your index.html in the browser. The provided script.js patch auto-connects
 # to the local WebSocket and fills the weight on screen 5 ("PESO") at the right time.
 #
 import asyncio
-import json
+import contextlib
+import logging
+import struct
 from binascii import hexlify
-from datetime import datetime, timedelta
 from collections import deque
 from typing import Optional, Tuple, Set
 
 from bleak import BleakScanner
-from Crypto.Cipher import AES  # pycryptodome
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESCCM  # OpenSSL EVP
+import orjson
 import websockets
+from websockets import broadcast as ws_broadcast
+from websockets.asyncio.server import ServerConnection
 
 # ===================== CONFIG DO DISPOSITIVO =====================
 TARGET_MAC  = "D0:7B:6F:30:C7:6A"                          # MAC da sua S200
 BINDKEY_HEX = "23d2c50a6b924c310d598de1f9781fe2"           # bindkey que você extraiu
+TARGET_PID  = None                                         # product_id da S200 (ex.: 0x1234); None = não filtra
 # ================================================================
 
 # ===================== CONFIG DO WEBSOCKET =======================
 WS_HOST = "127.0.0.1"
 WS_PORT = 8765
+COALESCE_SECS = 0.05   # janela para juntar leituras num único frame
+COALESCE_MAX = 16
 # ================================================================
 
 FE95_UUID = "0000fe95-0000-1000-8000-00805f9b34fb"
+FRAME_CTRL_ENCRYPTED = 0x0008   # bit 3 do frame_ctrl: payload cifrado
 KEY = bytes.fromhex(BINDKEY_HEX.lower())
 
-# janela de estabilização
+# campos little-endian: cabeçalho (frame_ctrl, product_id, frame_cnt) e peso
+_HDR = struct.Struct("<HHB")
+_WEIGHT = struct.Struct("<H")
+
+# AES-CCM (MiBeacon): nonce de 12 bytes, tag de 4 bytes, AAD = 0x11.
+# Criado uma única vez; o CCM inteiro roda no OpenSSL.
+_CCM = AESCCM(KEY, tag_length=4)
+_AAD = b"\x11"
+
+# nonce = MAC invertido (6) + product_id (2) + frame_cnt (1) + payload_counter (3)
+_MAC_REV = bytes.fromhex(TARGET_MAC.replace(":", ""))[::-1]
+_NONCE_BUF = bytearray(12)
+_NONCE_BUF[0:6] = _MAC_REV
+# MAC embutido no frame (offset 5) comparado como dois inteiros (u32 + u16)
+_MAC_CMP = struct.Struct("<IH")
+_MAC_REV_KEY = _MAC_CMP.unpack(_MAC_REV)
+
+# janela de estabilização (pesos em centi-kg inteiros, como vêm da balança)
 WINDOW = deque(maxlen=3)
-TOL_KG = 0.1
+TOL_CKG = 10   # 0,1 kg
 AUTO_RESET_SECS = 20
 already_sent = False
-last_seen = None
+last_seen: Optional[float] = None   # loop.time() (monotônico) do último pacote
+_last_frame_cnt = -1   # a balança repete o mesmo frame várias vezes por segundo
+_last_weight: Optional[int] = None   # peso decifrado desse frame (None = sem peso)
+
+logger = logging.getLogger("balanca")
 
 # Conexões WebSocket ativas
-CLIENTS: Set[websockets.WebSocketServerProtocol] = set()
+CLIENTS: Set[ServerConnection] = set()
+# Saída para o browser (criada em main): leituras {kg, stable} ou mensagens com "type"
+OUT_Q: Optional[asyncio.Queue] = None
 
 # -------------------- Utils BLE --------------------
-def le_u16(b: bytes) -> int:
-    return int.from_bytes(b, "little")
-
 def pretty_hex(b: bytes) -> str:
     return hexlify(b).decode()
 
-def has_embedded_mac(service: bytes, mac_rev: bytes) -> bool:
-    return len(service) >= 11 and service[5:11] == mac_rev
+def has_embedded_mac(service: memoryview) -> bool:
+    return len(service) >= 11 and _MAC_CMP.unpack_from(service, 5) == _MAC_REV_KEY
 
-def split_encrypted_block(service: bytes, mac_rev: bytes):
+def split_encrypted_block(service: memoryview):
+    # com memoryview, todas as fatias abaixo são views (sem cópia)
     if len(service) < 5 + 7:
         raise ValueError("service_data muito curto")
-    enc_start = 11 if has_embedded_mac(service, mac_rev) else 5
+    enc_start = 11 if has_embedded_mac(service) else 5
     enc = service[enc_start:]
     if len(enc) < 7:
         raise ValueError("encrypted_payload muito curto")
@@ -67,67 +98,85 @@ def split_encrypted_block(service: bytes, mac_rev: bytes):
     cipherpayload = enc[:-7]
     return cipherpayload, tag, payload_counter, enc_start
 
-def decrypt_mibeacon(service: bytes, mac_str: str) -> Optional[bytes]:
+def decrypt_mibeacon(service: memoryview) -> Optional[bytes]:
     if len(service) < 5:
         return None
-    mac_rev = bytes.fromhex(mac_str.replace(":", ""))[::-1]
-    pid_le = service[2:4]
-    frame_cnt = service[4:5]
     try:
-        cipherpayload, tag, payload_counter, _ = split_encrypted_block(service, mac_rev)
+        cipherpayload, tag, payload_counter, _ = split_encrypted_block(service)
     except Exception:
         return None
-    nonce = mac_rev + pid_le + frame_cnt + payload_counter
+    _NONCE_BUF[6:8] = service[2:4]
+    _NONCE_BUF[8:9] = service[4:5]
+    _NONCE_BUF[9:12] = payload_counter
     try:
-        cipher = AES.new(KEY, AES.MODE_CCM, nonce=nonce, mac_len=4)
-        cipher.update(b"\x11")
-        return cipher.decrypt_and_verify(cipherpayload, tag)
-    except Exception:
+        return _CCM.decrypt(bytes(_NONCE_BUF), b"".join((cipherpayload, tag)), _AAD)
+    except (InvalidTag, ValueError):
         return None
 
-def extract_weight_from_plain(plain: bytes) -> Optional[float]:
+def extract_weight_from_plain(plain: bytes) -> Optional[int]:
+    """Peso em centi-kg (5,00–150,00 kg), ou None."""
     if len(plain) < 6:
         return None
-    raw = le_u16(plain[4:6])
-    kg = raw / 100.0
-    if 5.0 <= kg <= 150.0:
-        return kg
+    raw = _WEIGHT.unpack_from(plain, 4)[0]
+    if 500 <= raw <= 15000:
+        return raw
     return None
 
-def weights_stable(values: deque, tol=TOL_KG) -> bool:
+def weights_stable(values: deque, tol=TOL_CKG) -> bool:
     if len(values) < values.maxlen:
         return False
     return (max(values) - min(values)) <= tol
 
 def maybe_autoreset():
-    global already_sent, last_seen, WINDOW
-    if last_seen and (datetime.now() - last_seen) > timedelta(seconds=AUTO_RESET_SECS):
+    global already_sent, last_seen, WINDOW, _last_frame_cnt, _last_weight
+    if last_seen is not None and asyncio.get_running_loop().time() - last_seen > AUTO_RESET_SECS:
         if already_sent or len(WINDOW) > 0:
-            print("🔁 Janela resetada (novo ciclo de pesagem).")
+            logger.info("🔁 Janela resetada (novo ciclo de pesagem).")
         already_sent = False
         WINDOW.clear()
         last_seen = None
+        _last_frame_cnt = -1
+        _last_weight = None
         # avisa browser para limpar UI de PESO
-        asyncio.create_task(broadcast({"type":"status","msg":"reset"}))
+        OUT_Q.put_nowait({"type":"status","msg":"reset"})
 
 # -------------------- WebSocket --------------------
-async def broadcast(msg: dict):
+def broadcast(msg: dict):
     if not CLIENTS:
         return
-    data = json.dumps(msg)
-    dead = set()
-    for ws in CLIENTS:
+    # orjson já entrega bytes UTF-8; text=True manda como frame de texto (sem
+    # recodificar) para o JSON.parse do browser continuar funcionando.
+    # envia para todos sem aguardar drain; quem passou do write_limit é pulado
+    ws_broadcast(CLIENTS, orjson.dumps(msg), text=True)
+
+async def broadcaster(q: asyncio.Queue):
+    # única task de envio: junta as leituras que chegam dentro de COALESCE_SECS
+    # num único frame; mensagens com "type" (status) saem avulsas, na ordem
+    while True:
+        items = [await q.get()]
+        await asyncio.sleep(COALESCE_SECS)
+        while len(items) < COALESCE_MAX and not q.empty():
+            items.append(q.get_nowait())
         try:
-            await ws.send(data)
+            batch = []
+            for item in items:
+                if "type" in item:
+                    if batch:
+                        broadcast({"type":"weights","items":batch})
+                        batch = []
+                    broadcast(item)
+                else:
+                    batch.append(item)
+            if batch:
+                broadcast({"type":"weights","items":batch})
         except Exception:
-            dead.add(ws)
-    for ws in dead:
-        CLIENTS.discard(ws)
+            # perde só este lote; a task continua viva para os próximos
+            logger.exception("Falha ao enviar mensagens para o browser")
 
 async def ws_handler(websocket):
     CLIENTS.add(websocket)
     try:
-        await websocket.send(json.dumps({"type":"status","msg":"connected"}))
+        await websocket.send(orjson.dumps({"type":"status","msg":"connected"}), text=True)
         async for _ in websocket:
             # we don't expect messages from the browser; it's a push channel
             pass
@@ -135,37 +184,57 @@ async def ws_handler(websocket):
         CLIENTS.discard(websocket)
 
 # -------------------- BLE pipeline --------------------
-def handle_service_data(service: bytes, mac: str, rssi: int):
-    global already_sent, last_seen
+def handle_service_data(service: memoryview, mac: str, rssi: int):
+    global already_sent, last_seen, _last_frame_cnt, _last_weight
 
     if len(service) <= 11:
         return  # keepalive curto
 
-    last_seen = datetime.now()
-    product_id = le_u16(service[2:4]) if len(service) >= 4 else None
-    frame_cnt = service[4] if len(service) >= 5 else None
+    last_seen = asyncio.get_running_loop().time()
+    frame_ctrl, product_id, frame_cnt = _HDR.unpack_from(service, 0)
 
-    plain = decrypt_mibeacon(service, mac)
-    print(f"📶 FE95 {mac} | RSSI {rssi} | len={len(service)} | {pretty_hex(service)}")
-    if plain is None:
-        print("  ↳ ❌ Não foi possível decifrar (provavelmente não é pacote de peso).")
+    # pré-filtro: só vale a pena decifrar frames cifrados da S200
+    if not frame_ctrl & FRAME_CTRL_ENCRYPTED:
         return
-
-    print(f"   🔓 plain = {pretty_hex(plain)}  (pid=0x{product_id:04x}, cnt={frame_cnt})")
-    w = extract_weight_from_plain(plain)
-    if w is None:
-        print("   ℹ️  Payload decifrado não contém peso no offset esperado.")
+    if TARGET_PID is not None and product_id != TARGET_PID:
         return
 
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if frame_cnt == _last_frame_cnt:
+        # retransmissão do mesmo frame: reaproveita o peso já decifrado, que
+        # continua contando para a janela de estabilização como antes
+        w = _last_weight
+        if w is None:
+            return
+    else:
+        _last_frame_cnt = frame_cnt
+        _last_weight = None
+
+        plain = decrypt_mibeacon(service)
+        if debug:
+            logger.debug("📶 FE95 %s | RSSI %s | len=%d | %s", mac, rssi, len(service), pretty_hex(service))
+        if plain is None:
+            logger.debug("  ↳ ❌ Não foi possível decifrar (provavelmente não é pacote de peso).")
+            return
+
+        if debug:
+            logger.debug("   🔓 plain = %s  (pid=0x%04x, cnt=%d)", pretty_hex(plain), product_id, frame_cnt)
+        w = extract_weight_from_plain(plain)
+        if w is None:
+            logger.debug("   ℹ️  Payload decifrado não contém peso no offset esperado.")
+            return
+        _last_weight = w
+
     WINDOW.append(w)
-    asyncio.create_task(broadcast({"type":"weight","kg":w,"stable":False}))
-    print(f"   🔎 Leitura: {w:.2f} kg | últimas={list(WINDOW)}")
+    OUT_Q.put_nowait({"kg":w / 100,"stable":False})
+    if debug:
+        logger.debug("   🔎 Leitura: %.2f kg | últimas (centi-kg)=%s", w / 100, list(WINDOW))
 
     if not already_sent and weights_stable(WINDOW):
-        stable = round(sum(WINDOW) / len(WINDOW), 2)
-        print(f"   ✅ Peso estabilizado: {stable:.2f} kg")
+        stable = round(sum(WINDOW) / len(WINDOW)) / 100
+        logger.info("   ✅ Peso estabilizado: %.2f kg", stable)
         already_sent = True
-        asyncio.create_task(broadcast({"type":"weight","kg":stable,"stable":True}))
+        OUT_Q.put_nowait({"kg":stable,"stable":True})
 
 def on_detection(device, adv):
     if device.address.upper() != TARGET_MAC.upper():
@@ -175,18 +244,13 @@ def on_detection(device, adv):
     raw = sd.get(FE95_UUID)
     if not raw:
         return
-    if isinstance(raw, memoryview):
-        raw = raw.tobytes()
-    elif not isinstance(raw, (bytes, bytearray)):
-        try:
-            raw = bytes(raw)
-        except Exception:
-            return
-    handle_service_data(bytes(raw), device.address, adv.rssi)
+    # bleak entrega bytes; a view evita qualquer cópia até a decifragem
+    assert isinstance(raw, (bytes, bytearray, memoryview))
+    handle_service_data(memoryview(raw), device.address, adv.rssi)
 
 async def run_ble_scanner():
-    print("🔍 Escutando FE95 da S200… (ignore pacotes len=11)")
-    print("👣 Pise até travar o visor. Feche Mi Home/Zepp Life. Aproxime o PC da balança.")
+    logger.info("🔍 Escutando FE95 da S200… (ignore pacotes len=11)")
+    logger.info("👣 Pise até travar o visor. Feche Mi Home/Zepp Life. Aproxime o PC da balança.")
     scanner = BleakScanner(on_detection)
     await scanner.start()
     try:
@@ -195,16 +259,28 @@ async def run_ble_scanner():
         await scanner.stop()
 
 async def main():
-    ws_server = await websockets.serve(ws_handler, WS_HOST, WS_PORT)
-    print(f"🌐 WebSocket em ws://{WS_HOST}:{WS_PORT}")
+    global OUT_Q
+    OUT_Q = asyncio.Queue()
+    sender = asyncio.create_task(broadcaster(OUT_Q))
+    # frames de peso são minúsculos: sem deflate, buffer de escrita folgado
+    ws_server = await websockets.serve(
+        ws_handler, WS_HOST, WS_PORT,
+        compression=None, write_limit=2**20, ping_interval=30, max_size=2**14,
+    )
+    logger.info("🌐 WebSocket em ws://%s:%d", WS_HOST, WS_PORT)
     try:
         await run_ble_scanner()
     finally:
+        sender.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await sender
         ws_server.close()
         await ws_server.wait_closed()
 
 if __name__ == "__main__":
+    # DEBUG mostra cada pacote FE95 (hex dump); é caro, deixe em INFO no uso normal
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n🛑 Encerrado pelo usuário.")
+        logger.info("🛑 Encerrado pelo usuário.")
@@ -262,6 +262,9 @@ navigator.serial?.addEventListener("disconnect", () => {
           if (msg.type === "weight") {
             onWeightFromWS(msg.kg, !!msg.stable);
           }
+          if (msg.type === "weights") {
+            for (const it of msg.items) onWeightFromWS(it.kg, !!it.stable);
+          }
         } catch {}
       });
     } catch (e) {